@@ -1,10 +1,19 @@
 import re
 import subprocess
 from pathlib import Path
-from multiprocessing import Pool, Lock, cpu_count
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import queue
+import atexit
 import traceback
 import os
 import shutil
+import sys
+import hashlib
+import json
+import itertools
+import mmap
+from collections import deque
 
 # -------- CONFIG --------
 md_file = Path(r"F:\MD-Proj\book.md")                 # Input Markdown
@@ -16,255 +25,855 @@ pdf_file = md_file.with_suffix(".pdf")                # Final PDF output
 pandoc_exe = "pandoc"                                 # Pandoc executable
 log_file = Path(r"F:\MD-Proj\conversion.log")         # Log file
 
-# -------- GLOBAL LOG LOCK --------
-log_lock = Lock()
+# -------- LOGGING (buffered, single writer thread) --------
+LOG_FLUSH_EVERY = 100  # messages between explicit flushes of the log file
+log_queue = queue.Queue()
 
 def log_print(message: str):
-    """Thread-safe log writer."""
-    with log_lock:
-        print(message)
-        with open(log_file, "a", encoding="utf-8") as log:
+    """Thread-safe log call: queues the message for the log writer thread."""
+    log_queue.put(message)
+
+def _log_writer(log):
+    pending = 0
+    with log:
+        while True:
+            message = log_queue.get()
+            if message is None:
+                break
+            print(message)
             log.write(message + "\n")
+            pending += 1
+            if pending >= LOG_FLUSH_EVERY:
+                log.flush()
+                pending = 0
 
-# -------- REGEXES FOR UML BLOCKS --------
-RE_FENCED = re.compile(r"(```\s*plantuml[^\n]*\n)(.*?)(\n```)", re.IGNORECASE | re.DOTALL)
-RE_STARTEND = re.compile(r"(@startuml\b.*?@enduml)", re.IGNORECASE | re.DOTALL)
-
-def find_uml_blocks(md_text: str):
+def start_logging(path: Path):
+    """
+    Open the log file once and start the thread that drains log_queue into it.
+    The queue is flushed and the file closed at interpreter exit.
+    """
+    log = open(path, "a", encoding="utf-8", buffering=1 << 16)
+    writer = threading.Thread(target=_log_writer, args=(log,), daemon=True)
+    writer.start()
+    atexit.register(stop_logging, writer)
+
+def stop_logging(writer: threading.Thread):
+    """Write out everything still queued, then close the log file."""
+    log_queue.put(None)
+    writer.join()
+
+# -------- READING MARKDOWN --------
+def map_markdown(path: Path):
+    """
+    Map the Markdown file read-only, so the UML regex scans the raw bytes and
+    only the pieces that are needed get decoded.
+    Returns an mmap, or b'' for an empty file (which cannot be mapped).
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def decode_markdown(data) -> str:
+    """Decode UTF-8 bytes with universal newlines, like Path.read_text() does."""
+    text = str(data, "utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+# -------- WRITING MARKDOWN --------
+WRITE_CHUNK = 1 << 20  # 1 MiB
+
+def iter_chunks(text: str, size: int = WRITE_CHUNK):
+    """Yield fixed-size slices of text, so it is encoded piece by piece."""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+def write_text_atomic(path: Path, text: str):
+    """
+    Stream text to '<path>.part' in chunks, then swap it into place, so a crash
+    never leaves a half-written file behind for Pandoc.
     """
-    Find both fenced ```plantuml blocks and @startuml ... @enduml blocks.
-    Returns a list of dicts with:
-      - 'span': tuple(start, end) of the match in the original text
+    part = path.with_name(path.name + ".part")
+    with open(part, "w", encoding="utf-8", buffering=WRITE_CHUNK, newline="") as f:
+        for chunk in iter_chunks(text):
+            f.write(chunk)
+    os.replace(part, path)
+
+# -------- REGEX FOR UML BLOCKS --------
+# One alternation, one pass: fenced ```plantuml blocks or bare @startuml ... @enduml
+# whose tags each start a line (tags mentioned inline in prose are not diagrams)
+RE_UML = re.compile(
+    rb"(?P<fenced>```\s*plantuml[^\n]*\n(?P<fcode>.*?)\r?\n```)"
+    rb"|(?P<se>^[ \t]*@startuml\b.*?^[ \t]*@enduml\b)",
+    re.IGNORECASE | re.DOTALL | re.MULTILINE,
+)
+# Every UML block contains "uml" in some letter case. Plain substring search
+# runs at memchr speed, far cheaper than a full RE_UML scan that finds nothing.
+UML_HINTS = [bytes(letters) for letters in itertools.product(b"uU", b"mM", b"lL")]
+
+def find_uml_blocks(md_data):
+    """
+    Find both fenced ```plantuml blocks and @startuml ... @enduml blocks in the
+    raw (UTF-8) Markdown bytes or mmap.
+    Returns a list of dicts, in document order, with:
+      - 'span': tuple(start, end) byte offsets of the match in md_data
       - 'original': exact original text to replace later
       - 'code': PlantUML source for rendering
       - 'kind': 'fenced' or 'startend'
     """
-    matches = []
+    if all(md_data.find(hint) == -1 for hint in UML_HINTS):
+        return []
 
-    # Fenced blocks
-    for m in RE_FENCED.finditer(md_text):
-        original = m.group(0)
-        code = m.group(2)
-        matches.append({
-            "span": (m.start(), m.end()),
-            "original": original,
-            "code": code,
-            "kind": "fenced",
-        })
-
-    # @startuml ... @enduml blocks
-    for m in RE_STARTEND.finditer(md_text):
-        original = m.group(1)
-        code = original  # keep as-is
-        matches.append({
-            "span": (m.start(1), m.end(1)),
-            "original": original,
-            "code": code,
-            "kind": "startend",
-        })
-
-    # Sort by position to ensure stable replacement order
-    matches.sort(key=lambda d: d["span"][0])
+    matches = []
+    for m in RE_UML.finditer(md_data):
+        if m.group("fenced") is not None:
+            matches.append({
+                "span": m.span(),
+                "original": decode_markdown(m.group(0)),
+                "code": decode_markdown(m.group("fcode")),
+                "kind": "fenced",
+            })
+        else:
+            original = decode_markdown(m.group("se"))
+            matches.append({
+                "span": m.span(),
+                "original": original,
+                "code": original,  # keep as-is
+                "kind": "startend",
+            })
     return matches
 
+def diagram_markdown(i: int, success: bool, info) -> str:
+    """Markdown that stands in for UML block i: the image, or a visible error note."""
+    if success:
+        safe_url = Path(info).as_posix()
+        # Limit image width to text width to avoid "Float too large" warnings
+        return f"![Diagram {i}]({safe_url}){{ width=100% }}"
+    return f"**Diagram {i} failed to generate: {info}**"
+
+def replace_uml_blocks(md_data, blocks, results) -> str:
+    """
+    Rebuild the document in one left-to-right pass over the raw bytes, swapping
+    each block's recorded span for its diagram Markdown, and decode it once.
+    Spans refer to the unmodified md_data.
+    """
+    parts = []
+    cur = 0
+    for (i, success, info), blk in zip(results, blocks):
+        start, end = blk["span"]
+        parts.append(md_data[cur:start])
+        parts.append(diagram_markdown(i, success, info).encode("utf-8"))
+        cur = end
+    parts.append(md_data[cur:])
+    return decode_markdown(b"".join(parts))
+
+WRAP_CHECK = 256  # the tags sit at the ends of a block; only look this far in
+
 def ensure_wrapped(code: str) -> str:
-    """Ensure the code has @startuml/@enduml around it."""
-    low = code.lower()
-    if "@startuml" in low and "@enduml" in low:
+    """
+    Ensure the code has @startuml/@enduml around it, each starting its own line:
+    PlantUML's -pipe mode only ends a diagram on a line starting with @end.
+    """
+    first_line = code[:WRAP_CHECK].lstrip().split("\n", 1)[0]
+    last_line = code[-WRAP_CHECK:].rstrip().rsplit("\n", 1)[-1].lstrip()
+    if first_line.lower().startswith("@startuml") and last_line.lower().startswith("@enduml"):
         return code
     return f"@startuml\n{code}\n@enduml"
 
-def escape_unescaped_dollars(s: str) -> str:
-    """
-    Escape all unescaped $ so LaTeX won't interpret them as math mode.
-    IMPORTANT: Call this on the final Markdown passed to Pandoc, NOT on PlantUML sources.
-    """
-    return re.sub(r"(?<!\\)\$", r"\\$", s)
+# -------- PAGE BREAKS + LATEX ESCAPES --------
+# A fenced code block (left untouched) and a '---' line (page break).
+# A backtick fence has no backtick in its info string ("```sh``` runs" is inline
+# code), and an unclosed fence runs to the end of the document, as in Pandoc.
+RE_FENCED_CODE = re.compile(
+    r"^[ ]{0,3}(`{3,}(?=[^`\n]*$)|~{3,})[^\n]*\n(?:.*?^[ ]{0,3}\1[`~]*[ \t]*$|.*\Z)",
+    re.MULTILINE | re.DOTALL,
+)
+RE_PAGEBREAK_LINE = re.compile(r"^[ \t]*---[ \t]*$", re.MULTILINE)
 
-# -------- PAGE BREAK HANDLING --------
-RE_PAGEBREAK_LINE = re.compile(r"^[ \t]*-{3}[ \t]*$", re.MULTILINE)
+YAML_HEADER_LIMIT = 64 * 1024  # a YAML header is only looked for this far in
 
 def split_yaml_header(md_text: str):
     """
     Split YAML header (if present) from the rest of the document.
     Returns (yaml_header, body). If no header, yaml_header is '' and body is original.
+    Only the first YAML_HEADER_LIMIT characters are scanned, line by line.
     """
-    text = md_text.lstrip('\ufeff')  # drop BOM if any
-    if text.startswith("---\n") or text.startswith("---\r\n"):
-        lines = text.splitlines(keepends=True)
-        header = []
-        body_start_idx = None
-        for i, line in enumerate(lines[1:], start=1):
-            if line.strip() in ("---", "..."):
-                body_start_idx = i + 1
-                break
-            header.append(line)
-        if body_start_idx is not None:
-            yaml_header = "---\n" + "".join(header) + lines[body_start_idx - 1]
-            body = "".join(lines[body_start_idx:])
-            return yaml_header, body
+    start = 1 if md_text[:1] == "\ufeff" else 0  # drop BOM if any
+    if md_text.startswith("---\n", start):
+        pos = start + 4
+    elif md_text.startswith("---\r\n", start):
+        pos = start + 5
+    else:
+        return "", md_text
+
+    header_start = pos
+    limit = min(len(md_text), start + YAML_HEADER_LIMIT)
+    while pos < limit:
+        newline = md_text.find("\n", pos, limit)
+        if newline == -1 and limit < len(md_text):
+            break  # line runs past the scan limit
+        end = limit if newline == -1 else newline + 1
+        if md_text[pos:end].strip() in ("---", "..."):
+            return "---\n" + md_text[header_start:end], md_text[end:]
+        pos = end
     # No YAML header
     return "", md_text
 
-def apply_page_breaks(md_text: str) -> str:
+def escape_unescaped_dollars(s: str) -> str:
+    """
+    Escape all unescaped $ so LaTeX won't interpret them as math mode.
+    Same result as re.sub(r"(?<!\\)\$", r"\\$", s): every $ gets a backslash,
+    then the ones that already had one lose it again. Two str.replace calls
+    beat the lookbehind regex by several times on large documents.
+    """
+    if "$" not in s:
+        return s
+    return s.replace("$", "\\$").replace("\\\\$", "\\$")
+
+def postprocess(body: str) -> str:
+    """
+    Prepare the document body (YAML header excluded) for LaTeX:
+    lines that are exactly '---' become page breaks (\newpage), and every
+    unescaped $ is escaped so LaTeX won't interpret it as math mode.
+    Fenced code blocks are copied as-is: they are typeset verbatim, where an
+    added backslash would show up in the PDF.
+    IMPORTANT: Call this on the final Markdown passed to Pandoc, NOT on PlantUML sources.
     """
-    Convert lines that are exactly '---' to LaTeX page breaks (\newpage),
-    excluding the YAML header area.
+    if "```" not in body and "~~~" not in body:
+        return _postprocess_prose(body)
+    parts = []
+    pos = 0
+    for m in RE_FENCED_CODE.finditer(body):
+        parts.append(_postprocess_prose(body[pos:m.start()]))
+        parts.append(m.group(0))
+        pos = m.end()
+    parts.append(_postprocess_prose(body[pos:]))
+    return "".join(parts)
+
+def _postprocess_prose(text: str) -> str:
+    if "---" in text:
+        text = RE_PAGEBREAK_LINE.sub(r"\n\\newpage\n", text)
+    return escape_unescaped_dollars(text)
+
+def prepare_markdown(md_data, blocks, results) -> str:
     """
+    The Markdown handed to Pandoc: UML blocks replaced by their results, then
+    page breaks and $ escapes applied (YAML header kept apart).
+    """
+    md_text = replace_uml_blocks(md_data, blocks, results) if blocks else decode_markdown(md_data)
     yaml_header, body = split_yaml_header(md_text)
-    body = RE_PAGEBREAK_LINE.sub(r"\n\\newpage\n", body)
-    return yaml_header + body
+    return escape_unescaped_dollars(yaml_header) + postprocess(body)
+
+# -------- SUBPROCESS OUTPUT (streamed to the log) --------
+STDERR_TAIL = 2048  # characters of stderr kept for error messages
+
+def _log_stream(stream, tail=None):
+    """Forward each line of a binary stream to the log; keep recent lines in tail."""
+    for line in stream:
+        text = line.decode("utf-8", errors="replace").rstrip()
+        if text:
+            log_print(text)
+            if tail is not None:
+                tail.append(text)
+
+def _tail_text(tail) -> str:
+    return "\n".join(tail)[-STDERR_TAIL:]
+
+def run_logged(cmd):
+    """
+    Run cmd, forwarding stdout/stderr to the log line by line as they arrive,
+    so memory stays bounded however much the tool prints.
+    Returns the exit code.
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1 << 16)
+    readers = [threading.Thread(target=_log_stream, args=(stream,)) for stream in (proc.stdout, proc.stderr)]
+    for reader in readers:
+        reader.start()
+    proc.wait()
+    for reader in readers:
+        reader.join()
+    return proc.returncode
 
 # -------- PANDOC WITH FONT FALLBACK --------
+# (mainfont, monofont) pairs in order of preference, common on Windows
+FONT_PAIRS = [
+    ("Times New Roman", "Consolas"),
+    ("Cambria", "Consolas"),
+    ("Calibri", "Consolas"),
+    ("Arial", "Consolas"),
+    ("Times New Roman", "Lucida Console"),
+    ("Times New Roman", "Courier New"),
+    # If installed, these are better for Unicode box-drawing:
+    ("Times New Roman", "Noto Sans Mono"),
+    ("Times New Roman", "DejaVu Sans Mono"),
+]
+
+WINDOWS_FONTS_KEY = r"SOFTWARE\Microsoft\Windows NT\CurrentVersion\Fonts"
+# Style words Windows appends to a family in its font registry ("Consolas Bold Italic").
+# Weights such as Light or Black are left alone: "Calibri Light" is a family of its own.
+RE_FONT_STYLE = re.compile(r"(?:\s+(?:Regular|Book|Bold|Semibold|Demibold|Italic|Oblique))+$", re.IGNORECASE)
+
+def installed_fonts():
+    """
+    Lower-cased names of the installed fonts, read once from the Windows font
+    registry (machine and per-user) or from fc-list elsewhere.
+    Returns None if the installed fonts cannot be determined.
+    """
+    names = set()
+    if sys.platform == "win32":
+        import winreg
+        for root in (winreg.HKEY_LOCAL_MACHINE, winreg.HKEY_CURRENT_USER):
+            try:
+                key = winreg.OpenKey(root, WINDOWS_FONTS_KEY)
+            except OSError:
+                continue
+            with key:
+                n = 0
+                while True:
+                    try:
+                        value_name = winreg.EnumValue(key, n)[0]
+                    except OSError:
+                        break
+                    n += 1
+                    # e.g. "Cambria & Cambria Math (TrueType)", "Consolas Bold Italic (TrueType)"
+                    value_name = re.sub(r"\s*\(.*\)\s*$", "", value_name)
+                    names.update(RE_FONT_STYLE.sub("", part.strip()).lower() for part in value_name.split("&"))
+        return names or None
+
+    if not shutil.which("fc-list"):
+        return None
+    try:
+        result = subprocess.run(["fc-list", ":", "family"], capture_output=True, text=True)
+    except OSError:
+        return None
+    for line in result.stdout.splitlines():
+        names.update(part.strip().lower() for part in line.split(","))
+    return names or None
+
+def font_installed(family: str, names) -> bool:
+    """True if family is one of names; 'Arial' does not match 'Arial Black'."""
+    return family.lower() in names
+
 def run_pandoc_with_font_fallback(md_path: Path, pdf_path: Path, pandoc_exe: str = "pandoc") -> int:
     """
-    Try Pandoc with several (mainfont, monofont) pairs common on Windows.
+    Run Pandoc with the first (mainfont, monofont) pair that is installed.
+    If the installed fonts cannot be listed, every pair is tried in turn.
+    Falls back to Pandoc's default fonts if that fails.
     Returns the subprocess return code; 0 means success.
     """
-    font_pairs = [
-        ("Times New Roman", "Consolas"),
-        ("Cambria", "Consolas"),
-        ("Calibri", "Consolas"),
-        ("Arial", "Consolas"),
-        ("Times New Roman", "Lucida Console"),
-        ("Times New Roman", "Courier New"),
-        # If installed, these are better for Unicode box-drawing:
-        ("Times New Roman", "Noto Sans Mono"),
-        ("Times New Roman", "DejaVu Sans Mono"),
-    ]
-
-    if not shutil.which(pandoc_exe):
+    pandoc_path = shutil.which(pandoc_exe)
+    if not pandoc_path:
         log_print(f"❌ '{pandoc_exe}' not found in PATH.")
         return 127
 
+    names = installed_fonts()
+    if names is None:
+        log_print("⚠️ Could not list installed fonts; trying each font pair.")
+        font_pairs = FONT_PAIRS
+    else:
+        font_pairs = [
+            (mainfont, monofont) for mainfont, monofont in FONT_PAIRS
+            if font_installed(mainfont, names) and font_installed(monofont, names)
+        ][:1]
+        if not font_pairs:
+            log_print("⚠️ None of the preferred font pairs is installed.")
+
     for mainfont, monofont in font_pairs:
         log_print(f"🔤 Trying fonts -> mainfont='{mainfont}', monofont='{monofont}'")
         cmd = [
-            pandoc_exe,
+            pandoc_path,
             str(md_path),
             "-o", str(pdf_path),
             "--pdf-engine=xelatex",
             "-V", f"mainfont={mainfont}",
             "-V", f"monofont={monofont}",
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.stdout.strip():
-            log_print(result.stdout)
-        if result.stderr.strip():
-            log_print(result.stderr)
-        if result.returncode == 0 and pdf_path.exists():
+        returncode = run_logged(cmd)
+        if returncode == 0 and pdf_path.exists():
             log_print(f"✅ PDF successfully generated with fonts: {mainfont} / {monofont}")
             return 0
         else:
             log_print(f"⚠️ Pandoc attempt failed with fonts: {mainfont} / {monofont}")
 
     log_print("🪂 Falling back to Pandoc defaults (no explicit fonts).")
-    result = subprocess.run(
-        [pandoc_exe, str(md_path), "-o", str(pdf_path), "--pdf-engine=xelatex"],
-        capture_output=True,
-        text=True
+    return run_logged([pandoc_path, str(md_path), "-o", str(pdf_path), "--pdf-engine=xelatex"])
+
+# -------- PLANTUML PIPE SERVER --------
+PIPE_DELIMITER = "__md2pdf_plantuml_end__"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+ANSWER_TIMEOUT = 120  # seconds one diagram may take before its JVM is killed
+
+def plantuml_pipe_cmd(plantuml_jar: Path):
+    """
+    PlantUML in -pipe mode: diagrams are read from stdin; each answer on stdout
+    is a PNG, then any ERROR lines (-pipeNoStderr), then a PIPE_DELIMITER line.
+    """
+    return ["java", "-jar", str(plantuml_jar), "-pipe", "-tpng", "-charset", "UTF-8",
+            "-pipeNoStderr", "-pipedelimitor", PIPE_DELIMITER]
+
+def start_plantuml_server(plantuml_jar: Path):
+    """Start a resident PlantUML JVM in -pipe mode (see plantuml_pipe_cmd)."""
+    proc = subprocess.Popen(
+        plantuml_pipe_cmd(plantuml_jar),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
     )
-    if result.stdout.strip():
-        log_print(result.stdout)
-    if result.stderr.strip():
-        log_print(result.stderr)
-    return result.returncode
+    # Keep stderr drained so a chatty JVM can never block on a full pipe
+    threading.Thread(target=_log_stream, args=(proc.stderr,), daemon=True).start()
+    return proc
 
-# -------- PLANTUML FUNCTION (PARALLEL) --------
-def process_uml(args):
+def stop_plantuml_server(proc) -> bool:
     """
-    Render a single PlantUML block to PNG.
-    Returns tuple(i, success, path_or_error).
+    Close the server's stdin and wait for the JVM to exit.
+    Returns True if it exited without writing anything beyond the answers
+    already read, i.e. every answer was matched to its job.
     """
-    i, code_text, plantuml_jar, output_dir = args
-    puml_file = output_dir / f"diagram{i}.puml"
-    png_file = output_dir / f"diagram{i}.png"
+    try:
+        proc.stdin.close()
+        return _no_extra_output(proc)
+    except Exception:
+        proc.kill()
+        proc.wait()
+        return False
 
+def _no_extra_output(proc) -> bool:
+    """
+    Read PlantUML's stdout to its end (stdin already closed) and wait for exit.
+    A JVM that has to be killed for taking too long is not verified.
+    """
     try:
-        if png_file.exists():
-            log_print(f"⏭ Diagram {i} already exists, skipping: {png_file}")
-            return (i, True, png_file)
+        extra = within_deadline(proc, proc.stdout.read)
+        proc.wait(timeout=10)
+    except (TimeoutError, subprocess.TimeoutExpired):
+        log_print("⚠️ PlantUML did not exit after its last answer")
+        proc.kill()
+        proc.wait()
+        return False
+    if extra:
+        log_print(f"⚠️ PlantUML wrote {len(extra)} unexpected bytes after its last answer")
+    return not extra
+
+def staged_png(png_file: Path) -> Path:
+    """Where an answer's PNG waits until the answers are known to be aligned."""
+    return png_file.with_name(png_file.name + ".part")
+
+def keep_answers(results):
+    """Move the staged PNGs of verified answers to their cache names."""
+    for _, success, png_file in results:
+        if success:
+            os.replace(staged_png(png_file), png_file)
+
+def discard_answers(results):
+    """Drop staged PNGs whose answers could not be verified."""
+    for _, success, png_file in results:
+        if success:
+            staged_png(png_file).unlink(missing_ok=True)
+
+def _read_exact(stream, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise EOFError("PlantUML closed its output")
+    return data
+
+def read_png(stream, signature: bytes) -> bytes:
+    """Read the rest of one PNG image (chunks through IEND) after its signature."""
+    data = bytearray(signature)
+    while True:
+        header = _read_exact(stream, 8)  # 4-byte length + 4-byte chunk type
+        data += header
+        data += _read_exact(stream, int.from_bytes(header[:4], "big") + 4)  # data + CRC
+        if header[4:] == b"IEND":
+            return bytes(data)
+
+def render_via_server(proc, i: int, uml_source: str, png_file: Path):
+    """
+    Render one diagram through a running PlantUML server.
+    Returns tuple(i, success, path_or_error); raises if the server died or
+    TimeoutError if it did not answer in time (the server is then killed).
+    """
+    def send_and_read():
+        proc.stdin.write(uml_source.encode("utf-8") + b"\n")
+        proc.stdin.flush()
+        return read_answer(proc.stdout, i, png_file, count_pipe_answers(uml_source))
 
-        # Do NOT touch dollar signs; LaTeX will never see this text.
-        uml_source = ensure_wrapped(code_text)
+    return within_deadline(proc, send_and_read)
 
-        puml_file.write_text(uml_source, encoding="utf-8")
+def within_deadline(proc, action):
+    """
+    Run action(), killing proc if it takes longer than ANSWER_TIMEOUT, so a
+    diagram PlantUML never finishes cannot hang the whole conversion.
+    Raises TimeoutError in that case, even if action() then returned what it
+    had read before the kill.
+    """
+    expired = threading.Event()
 
-        result = subprocess.run(
-            ["java", "-jar", str(plantuml_jar), "-tpng", str(puml_file)],
-            capture_output=True,
-            text=True
-        )
+    def expire():
+        expired.set()
+        proc.kill()
+
+    timer = threading.Timer(ANSWER_TIMEOUT, expire)
+    timer.daemon = True
+    timer.start()
+    try:
+        result = action()
+    except (OSError, EOFError):
+        if not expired.is_set():
+            raise
+        result = None
+    finally:
+        timer.cancel()
+    if expired.is_set():
+        raise TimeoutError(f"no answer from PlantUML within {ANSWER_TIMEOUT} s")
+    return result
+
+def count_pipe_answers(uml_source: str) -> int:
+    """
+    Number of answers PlantUML -pipe writes for uml_source: one per line
+    starting with @start… that a later line starting with @end… closes.
+    """
+    count = 0
+    inside = False
+    for line in uml_source.splitlines():
+        line = line.lstrip().lower()
+        if line.startswith("@start"):
+            inside = True
+        elif inside and line.startswith("@end"):
+            count += 1
+            inside = False
+    return max(count, 1)
+
+def _read_one_answer(stream):
+    """
+    Read one answer: a PNG (or error text in its place), any ERROR lines and
+    the delimiter. Returns (png_or_None, lines).
+    """
+    head = _read_exact(stream, len(PNG_SIGNATURE))
+    if head == PNG_SIGNATURE:
+        return read_png(stream, head), _read_to_delimiter(stream)
+    return None, _read_to_delimiter(stream, head)
+
+def _read_to_delimiter(stream, pending: bytes = b""):
+    """Text lines up to the PIPE_DELIMITER line; pending holds bytes already read."""
+    lines = []
+    while True:
+        while b"\n" in pending:
+            raw, pending = pending.split(b"\n", 1)
+            line = raw.decode("utf-8", errors="replace").rstrip("\r")
+            if line == PIPE_DELIMITER:
+                return lines
+            lines.append(line)
+        chunk = stream.readline()
+        if not chunk:
+            raise EOFError("PlantUML closed its output")
+        pending += chunk
+
+def read_answer(stream, i: int, png_file: Path, answers: int = 1):
+    """
+    Read diagram i's answers from PlantUML -pipe output and stage the PNG
+    (see keep_answers).
+    A source holding several diagrams gets one answer each; only the first is
+    kept and the rest are skipped, so the stream stays aligned with the jobs.
+    Returns tuple(i, success, path_or_error); raises if the output ended early.
+    """
+    png, errors = _read_one_answer(stream)
+    for _ in range(answers - 1):
+        _read_one_answer(stream)
+    if png is None and not errors:
+        errors = ["PlantUML did not answer with a PNG image"]
 
+    if errors:
         log_print(f"\n--- PlantUML Diagram {i} ---")
-        if result.stdout.strip():
-            log_print(result.stdout)
-        if result.stderr.strip():
-            log_print(result.stderr)
-
-        if result.returncode != 0:
-            log_print(f"❌ Error generating diagram {i} (exit code {result.returncode})")
-            return (i, False, result.stderr.strip())
-        else:
-            log_print(f"✅ Diagram {i} generated: {png_file}")
-            return (i, True, png_file)
+        log_print("\n".join(errors))
+        log_print(f"❌ Error generating diagram {i}")
+        return (i, False, "\n".join(errors).strip())
 
+    staged_png(png_file).write_bytes(png)
+    log_print(f"✅ Diagram {i} generated: {png_file}")
+    return (i, True, png_file)
+
+def render_with_server(jobs: queue.Queue, plantuml_jar: Path):
+    """
+    Pull jobs from the shared queue and render them through one resident
+    PlantUML server until the queue is empty.
+    Answers are kept only if the server then shuts down with no output left
+    over, which proves each answer matched its job.
+    Returns (results, leftover). If the server died, could not be verified or
+    timed out, the jobs it took go back as leftover, except a timed-out job,
+    which is reported as failed. If it cannot start, the jobs stay queued.
+    """
+    try:
+        proc = start_plantuml_server(plantuml_jar)
+    except Exception as e:
+        log_print(f"⚠️ Could not start PlantUML server: {e}")
+        return [], []
+
+    taken = []      # jobs this server answered (or was answering when it died)
+    results = []
+    failed = []
+    stopped_cleanly = False
+    try:
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                break
+            i, uml_source, png_file = job
+            try:
+                results.append(render_via_server(proc, i, uml_source, png_file))
+                taken.append(job)
+            except TimeoutError as e:
+                # Retrying elsewhere would hang the same way
+                log_print(f"❌ Error generating diagram {i}: {e}")
+                failed.append((i, False, str(e)))
+                break
+            except (OSError, EOFError) as e:
+                log_print(f"⚠️ PlantUML server stopped at diagram {i}: {e}")
+                taken.append(job)
+                break
+    finally:
+        stopped_cleanly = stop_plantuml_server(proc)
+
+    if stopped_cleanly and len(results) == len(taken) and not failed:
+        keep_answers(results)
+        return results, []
+    discard_answers(results)
+    return failed, taken
+
+# -------- PLANTUML BATCH RENDERING (FALLBACK) --------
+def render_uml_batch(jobs, plantuml_jar: Path):
+    """
+    Render jobs in one fresh PlantUML JVM, used when the pipe servers fail.
+    All sources go in on stdin in a single run; nothing is written to .puml files.
+    Each PNG is staged as soon as it arrives and stderr is streamed to the log.
+    If the JVM dies or hangs, the diagram in flight fails and the others are
+    retried in a fresh JVM. If the answers cannot be verified to match their
+    jobs, each job is retried in a JVM of its own.
+    Returns a list of tuple(i, success, path_or_error).
+    """
+    source = "".join(uml_source + "\n" for _, uml_source, _ in jobs).encode("utf-8")
+    log_print(f"\n--- PlantUML batch: {len(jobs)} diagrams ---")
+    try:
+        proc = subprocess.Popen(
+            plantuml_pipe_cmd(plantuml_jar),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=1 << 16,
+        )
     except Exception as e:
         tb = traceback.format_exc()
-        log_print(f"❌ Exception generating diagram {i}: {e}\n{tb}")
-        return (i, False, str(e))
+        log_print(f"❌ Exception running PlantUML: {e}\n{tb}")
+        return [(i, False, str(e)) for i, _, _ in jobs]
+
+    tail = deque(maxlen=64)
+    stderr_reader = threading.Thread(target=_log_stream, args=(proc.stderr, tail))
+    stderr_reader.start()
+    threading.Thread(target=_feed_stdin, args=(proc.stdin, source), daemon=True).start()
+
+    results = []
+    for n, (i, uml_source, png_file) in enumerate(jobs):
+        answers = count_pipe_answers(uml_source)
+        try:
+            results.append(within_deadline(proc, lambda: read_answer(proc.stdout, i, png_file, answers)))
+        except (OSError, EOFError) as e:  # TimeoutError included
+            proc.kill()
+            returncode = proc.wait()
+            stderr_reader.join()
+            discard_answers(results)
+            if isinstance(e, TimeoutError):
+                info = str(e)
+            else:
+                info = _tail_text(tail) or f"exit code {returncode}"
+            log_print(f"❌ Error generating diagram {i} (exit code {returncode}): {e}")
+            if n == 0 and not isinstance(e, TimeoutError):
+                # Died before its first answer: a fresh JVM would fail the same way
+                return [(j, False, info) for j, _, _ in jobs]
+            results = [(i, False, info)]
+            rest = jobs[:n] + jobs[n + 1:]
+            if rest:
+                results.extend(render_uml_batch(rest, plantuml_jar))
+            return results
+
+    try:
+        verified = _no_extra_output(proc)
+    except (OSError, EOFError):
+        proc.kill()
+        proc.wait()
+        verified = False
+    stderr_reader.join()
+    if not verified:
+        discard_answers(results)
+        if len(jobs) == 1:
+            i = jobs[0][0]
+            log_print(f"❌ Error generating diagram {i}: PlantUML answers out of sync")
+            return [(i, False, "PlantUML answers out of sync")]
+        # One job per JVM keeps every answer aligned, so only the bad diagram fails
+        log_print(f"⚠️ PlantUML answers out of sync, rendering {len(jobs)} diagrams one by one")
+        return [result for job in jobs for result in render_uml_batch([job], plantuml_jar)]
+    keep_answers(results)
+    return results
+
+def _feed_stdin(stdin, data: bytes):
+    try:
+        stdin.write(data)
+        stdin.close()
+    except OSError:
+        pass  # the JVM exited early; the reader reports it
+
+# -------- DIAGRAM CACHE (keyed on UML source) --------
+CACHE_FILE = "cache.json"
+
+def uml_hash(uml_source: str) -> str:
+    """Short SHA-256 of the wrapped PlantUML source; names the cached PNG."""
+    return hashlib.sha256(uml_source.encode("utf-8")).hexdigest()[:16]
+
+def update_diagram_cache(output_dir: Path, cached: dict):
+    """
+    Write cache.json (hash -> PNG name) and delete the PNGs of diagrams that an
+    earlier run cached but that no longer appear in the document.
+    """
+    cache_path = output_dir / CACHE_FILE
+    try:
+        previous = json.loads(cache_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        previous = {}
+    if not isinstance(previous, dict):
+        previous = {}
+
+    for h, name in previous.items():
+        if h in cached:
+            continue
+        stale = output_dir / Path(str(name)).name
+        if stale.exists():
+            stale.unlink()
+            log_print(f"🧹 Removed stale diagram file: {stale}")
+
+    cache_path.write_text(json.dumps(cached, indent=2, sort_keys=True), encoding="utf-8")
+
+# -------- PLANTUML RENDERING --------
+def plan_diagrams(blocks, output_dir: Path):
+    """
+    Add the wrapped PlantUML 'source', its 'hash' and the cached 'png' path
+    to each block.
+    Returns the results expected if every diagram renders: tuple(i, True, png).
+    """
+    for blk in blocks:
+        # Do NOT touch dollar signs; LaTeX will never see this text.
+        blk["source"] = ensure_wrapped(blk["code"])
+        blk["hash"] = uml_hash(blk["source"])
+        blk["png"] = output_dir / f"d_{blk['hash']}.png"
+    return [(i, True, blk["png"]) for i, blk in enumerate(blocks, start=1)]
+
+def render_uml(blocks, plantuml_jar: Path, output_dir: Path, num_workers: int):
+    """
+    Render all PlantUML blocks (prepared by plan_diagrams) to PNG, cached as
+    d_<hash>.png by source content so unchanged diagrams are never re-rendered,
+    wherever they move in the book.
+    Up to num_workers threads each drive their own resident PlantUML server and
+    pull diagrams from a shared queue; anything a server could not render goes
+    to the batch CLI.
+    Returns a list of tuple(i, success, path_or_error), one per block, in order.
+    """
+    results = {}
+    jobs = []
+    first_of = {}   # hash -> index of the first block with that source
+    cached = {}     # hash -> PNG name, for every diagram available after this run
+    # One directory listing instead of a stat() per diagram
+    with os.scandir(output_dir) as entries:
+        existing = {entry.name for entry in entries if entry.name.endswith(".png")}
+
+    for i, blk in enumerate(blocks, start=1):
+        png_file = blk["png"]
+        if blk["hash"] in first_of:
+            continue  # identical source: reuses the first block's render
+        first_of[blk["hash"]] = i
+        if png_file.name in existing:
+            log_print(f"⏭ Diagram {i} already rendered, skipping: {png_file}")
+            results[i] = (i, True, png_file)
+            continue
+        jobs.append((i, blk["source"], png_file))
+
+    leftover = []
+    if jobs:
+        # Shared queue: a server that finishes early simply takes the next job.
+        # Longest sources first, so a big diagram is not left for the very end.
+        job_queue = queue.Queue()
+        for job in sorted(jobs, key=lambda job: len(job[1]), reverse=True):
+            job_queue.put(job)
+
+        # One JVM per thread, never more than there are diagrams to render
+        num_servers = min(num_workers, len(jobs))
+        log_print(f"🧩 Rendering {len(jobs)} diagrams with {num_servers} PlantUML server threads...")
+        with ThreadPoolExecutor(max_workers=num_servers) as ex:
+            futures = [ex.submit(render_with_server, job_queue, plantuml_jar) for _ in range(num_servers)]
+            for future in as_completed(futures):
+                done, rest = future.result()
+                results.update((r[0], r) for r in done)
+                leftover.extend(rest)
+
+        # Jobs nobody picked up because every server failed
+        while not job_queue.empty():
+            leftover.append(job_queue.get_nowait())
+
+    if leftover:
+        log_print(f"🪂 Falling back to batch PlantUML for {len(leftover)} diagrams.")
+        results.update((r[0], r) for r in render_uml_batch(leftover, plantuml_jar))
+
+    for h, i in first_of.items():
+        if results[i][1]:
+            cached[h] = Path(results[i][2]).name
+    update_diagram_cache(output_dir, cached)
+
+    return [(i, *results[first_of[blk["hash"]]][1:]) for i, blk in enumerate(blocks, start=1)]
 
 # -------- MAIN WORKFLOW --------
 if __name__ == "__main__":
-    # Optional: Unicode output for Windows console
+    # Optional: Unicode output for Windows console (in-process, no cmd.exe spawn)
     try:
-        os.system("chcp 65001 >nul")
+        sys.stdout.reconfigure(encoding="utf-8")
+        sys.stderr.reconfigure(encoding="utf-8")
     except Exception:
         pass
 
     log_file.unlink(missing_ok=True)
+    start_logging(log_file)
     log_print("🚀 Starting diagram extraction and conversion...")
 
-    # -------- READ MARKDOWN --------
-    md_text = md_file.read_text(encoding="utf-8")
+    # -------- READ MARKDOWN (memory-mapped, decoded only once) --------
+    md_data = map_markdown(md_file)
 
     # -------- EXTRACT UML BLOCKS (BOTH FORMS) --------
-    blocks = find_uml_blocks(md_text)
+    blocks = find_uml_blocks(md_data)
     total = len(blocks)
     log_print(f"📊 Found {total} UML diagrams.")
 
     if total == 0:
         log_print("⚠️ No diagrams found. Skipping PlantUML generation.")
+        results = []
     else:
-        # -------- PARALLEL PROCESSING --------
-        num_proc = min(cpu_count(), 6)
-        log_print(f"🧩 Using {num_proc} parallel processes...")
-
-        args = [(i, blk["code"], plantuml_jar, output_dir) for i, blk in enumerate(blocks, start=1)]
-
-        with Pool(processes=num_proc) as pool:
-            results = pool.map(process_uml, args)
-
-        # -------- UPDATE MARKDOWN: replace each UML block with an image --------
-        for (i, success, info), blk in zip(results, blocks):
-            if success:
-                safe_url = Path(info).as_posix()
-                # Limit image width to text width to avoid "Float too large" warnings
-                replacement = f"![Diagram {i}]({safe_url}){{ width=100% }}"
-            else:
-                # Visible error note in the document
-                replacement = f"**Diagram {i} failed to generate: {info}**"
-
-            # Replace only the first occurrence of the exact original block
-            md_text = md_text.replace(blk["original"], replacement, 1)
-
-    # -------- PAGE BREAKS: convert --- lines to \newpage (excluding YAML header) --------
-    md_text = apply_page_breaks(md_text)
-
-    # -------- SAVE TEMP MARKDOWN --------
-    # Escape any remaining unescaped $ in the Markdown that Pandoc will see.
-    md_text_safe = escape_unescaped_dollars(md_text)
-    temp_md.write_text(md_text_safe, encoding="utf-8")
+        # -------- PARALLEL RENDERING (resident PlantUML servers, in the background) --------
+        # Each worker thread owns a JVM that renders on its own cores
+        num_workers = min(os.cpu_count() or 1, 6)
+        expected = plan_diagrams(blocks, output_dir)
+        render_executor = ThreadPoolExecutor(max_workers=1)
+        render_future = render_executor.submit(render_uml, blocks, plantuml_jar, output_dir, num_workers)
+        # PNG paths are known up front, so the Markdown is prepared while rendering runs
+        results = expected
+
+    # -------- UPDATE MARKDOWN, PAGE BREAKS + $ ESCAPES, SAVE TEMP MARKDOWN --------
+    write_text_atomic(temp_md, prepare_markdown(md_data, blocks, results))
+
+    if total:
+        # -------- WAIT FOR DIAGRAMS; patch in any failures before Pandoc --------
+        results = render_future.result()
+        render_executor.shutdown()
+        if any(not success for _, success, _ in results):
+            write_text_atomic(temp_md, prepare_markdown(md_data, blocks, results))
+
+    if isinstance(md_data, mmap.mmap):
+        md_data.close()
 
     # -------- CONVERT TO PDF USING PANDOC (with font fallback) --------
     log_print("\n--- Starting Pandoc conversion ---")